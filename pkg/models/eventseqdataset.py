@@ -19,13 +19,21 @@ class EventSeqDataset(Dataset):
     def __init__(self, event_seqs, min_length=1, sort_by_length=False):
 
         self.min_length = min_length
-        self._event_seqs = [
+        event_seqs = [
             torch.FloatTensor(seq)
             for seq in event_seqs
             if len(seq) >= min_length
         ]
         if sort_by_length:
-            self._event_seqs = sorted(self._event_seqs, key=lambda x: -len(x))
+            event_seqs = sorted(event_seqs, key=lambda x: -len(x))
+
+        # all events are kept in one contiguous buffer of shape [n_events, F];
+        # the sequences are views into it
+        self._event_seqs = (
+            list(torch.cat(event_seqs).split([len(seq) for seq in event_seqs]))
+            if event_seqs
+            else []
+        )
 
     def __len__(self):
         return len(self._event_seqs)
@@ -36,4 +44,13 @@ class EventSeqDataset(Dataset):
 
     @staticmethod
     def collate_fn(X):
-        return nn.utils.rnn.pad_sequence(X, batch_first=True)
\ No newline at end of file
+        """Pad a list of sequences into a batch.
+
+        Returns:
+            FloatTensor: size=[B, T, F], zero-padded event sequences.
+            LongTensor: size=[B], lengths of the sequences.
+        """
+        return (
+            nn.utils.rnn.pad_sequence(X, batch_first=True),
+            torch.LongTensor([len(x) for x in X]),
+        )
\ No newline at end of file
@@ -2,14 +2,12 @@
 """
 import sys
 from collections import defaultdict
-from functools import partial
+from functools import lru_cache, partial
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
-from torch.utils.data import Dataset
+from torch.utils.checkpoint import checkpoint
 from tqdm import tqdm
 
 from ..utils.misc import AverageMeter
@@ -19,71 +17,56 @@ import math
 
 
 
-def subsequent_mask(size):
-    "mask out subsequent positions"
+@lru_cache(maxsize=32)
+def subsequent_mask(size, device=None):
+    "mask out subsequent positions, cached per (size, device); the returned tensor must not be modified in place"
     atten_shape = (1,size,size) #note the shape indicates self-to-self pairing (causal masking)
-    mask = np.triu(np.ones(atten_shape),k=1).astype('uint8') #Upper triangle of an array.
-    aaa = torch.from_numpy(mask) == 0
-    return aaa
+    return torch.ones(atten_shape, dtype=torch.bool, device=device).tril() #Lower triangle (including the diagonal) is kept.
+
+
+def _state_excitation(v_alpha, v_gamma, dt_arr):
+    # * element-wise product, summation along dim:-3 (time), i.e. the pre-tanh excitation from the history events
+    return torch.sum(v_alpha * v_gamma * torch.exp(-v_gamma * dt_arr), -3)
+
+
+def _state_decay(v_mu, v_alpha, v_gamma, dt_arr):
+    #+ 1e-3  ???
+    return torch.tanh(v_mu + _state_excitation(v_alpha, v_gamma, dt_arr))
 
 
 class MaskBatch():
     "object for holding a batch of data with mask during training"
-    def __init__(self,src,pad, device):
+    def __init__(self,src,pad):
         self.src = src
-        self.src_mask = self.make_std_mask(self.src, pad, device) #pad=0.
+        self.src_mask = self.make_std_mask(self.src, pad) #pad=0.
 
     @staticmethod
-    def make_std_mask(tgt,pad,device):
+    def make_std_mask(tgt,pad):
         "create a mask to hide padding and future input"
         tgt_mask = (tgt != pad).unsqueeze(-2) #pad=0.
         # torch.transpose(tgt_mask,1,2) is transposing the tgt_mask matrix which essentially swaps the last two dimensions.
-        tgt_mask = tgt_mask & torch.transpose(tgt_mask,1,2) & Variable(subsequent_mask(tgt.size(-1)).type_as(tgt_mask.data)).to(device)
+        tgt_mask = tgt_mask & torch.transpose(tgt_mask,1,2) & subsequent_mask(tgt.size(-1), tgt.device)
         return tgt_mask
 
-class EventSeqDataset(Dataset):
-    """Construct a dataset for store event sequences.
-
-    Args:
-        event_seqs (list of list of 2-tuples):
-    """
-
-    def __init__(self, event_seqs, min_length=1, sort_by_length=False):
-
-        self.min_length = min_length
-        self._event_seqs = [
-            torch.FloatTensor(seq)
-            for seq in event_seqs
-            if len(seq) >= min_length
-        ]
-        if sort_by_length:
-            self._event_seqs = sorted(self._event_seqs, key=lambda x: -len(x))
-
-    def __len__(self):
-        return len(self._event_seqs)
-
-    def __getitem__(self, i):
-        return self._event_seqs[i]
-
-    @staticmethod
-    def collate_fn(X):
-        return nn.utils.rnn.pad_sequence(X, batch_first=True)
-
 class Attention(nn.Module):
     """
     Compute 'Scaled Dot Product Attention
+    query is expected to be already scaled by 1/sqrt(d_k)
     """
     def forward(self, query, key, value, mask=None, dropout=None):
 
-        scores = torch.matmul(query, key.transpose(-2, -1)) \
-                 / math.sqrt(query.size(-1)) #Since both query and key are rank-4 tensor batch_size * num_heads * seq_len * d_k, dot prodct torch.matmul(query, key.transpose(-2, -1)) is batch_size * num_heads * seq_len * seq_len
+        scores = torch.matmul(query, key.transpose(-2, -1)) #Since both query and key are rank-4 tensor batch_size * num_heads * seq_len * d_k, dot prodct torch.matmul(query, key.transpose(-2, -1)) is batch_size * num_heads * seq_len * seq_len
 
         if mask is not None:
-            scores = scores.masked_fill(mask == 0., -1e9)
+            # mask is boolean, True where attention is allowed; the most negative finite value (not -inf) keeps the fully masked
+            # (padding) rows finite: they come out uniform instead of NaN
+            scores = scores.masked_fill(~mask, torch.finfo(scores.dtype).min)
         #Softmax (scaled) attention scores, along the last dimension (of the attention matrix, in which first dimension is current token, second dimension is the token prior the current token), which becomes attention probability.
-        p_attn = F.softmax(scores, dim=-1) #along the seq_len dimension
+        p_attn = F.softmax(scores, dim=-1) #along the seq_len dimension, masked entries of the other rows are exactly 0.
         if mask is not None:
-            p_attn = p_attn.masked_fill(mask == 0., 0.) # same as scores, p_attn is a rank-4 tensor batch_size*number_heads*seq_len*seq_len
+            # only the padding rows still need zeroing, through a (.. x seq_len x 1) row mask: the flattened alpha/gamma features mix rows,
+            # so they must not see the uniform padding rows. p_attn is a rank-4 tensor batch_size*number_heads*seq_len*seq_len
+            p_attn = p_attn * mask.any(-1, keepdim=True)
         #The matrix multiplocation of Query to the scaled dot-product attention scores of past tokens: Q @ softmax( K . V )
         return torch.matmul(p_attn, value), p_attn #torch.matmul(p_attn, value) results in rank-4 tensor batch_size * number_heads * seq_len * d_k
 
@@ -102,20 +85,17 @@ class MultiHeadedAttention(nn.Module):
         self.d_model = d_model
         self.d_k = d_model // h  #d_k appears to be related to K (number of types), why is d_k associated with d_model?
         self.h = h
+        self.scale = 1. / math.sqrt(self.d_k) # folded into the query (B x h x L x d_k) rather than applied to the scores (B x h x L x L)
 
         self.linear_layers = nn.ModuleList([nn.Linear(d_model, d_model, bias=True) for _ in range(3)])
 
-        self.output_alpha = nn.Linear(d_model, d_model, bias=True) # output_alpha never used ??
-        #As the name suggests d_k is number of types (K) , which is the out_features of alpha_layer, gamma_layer, mu_layer
-        self.alpha_layer = nn.Sequential(
-            nn.Linear(int(self.d_k*self.h/2), self.d_k, bias=True)
-            ,nn.Softplus(beta=1.0)
-        )
-
-        self.gamma_layer = nn.Sequential(
-            nn.Linear(int(self.d_k*self.h/2), self.d_k, bias=True)
-            ,nn.Softplus(beta=10.0)
-        )
+        #As the name suggests d_k is number of types (K) , which is the out_features of alpha/gamma linear layers, mu_layer
+        #alpha and gamma linear layers are stacked along the first dimension ([0]: alpha, [1]: gamma) so both run as one batched GEMM;
+        #they are followed by Softplus(beta=1.0) and Softplus(beta=10.0) respectively in forward()
+        assert h % 2 == 0 # heads are split evenly between alpha and gamma
+        self.alpha_gamma_weight = nn.Parameter(torch.empty(2, self.d_k, int(self.d_k*self.h/2)))
+        self.alpha_gamma_bias = nn.Parameter(torch.empty(2, self.d_k))
+        self.reset_alpha_gamma_parameters()
 
         self.mu_layer = nn.Sequential(
             nn.Linear(self.d_model, self.d_k, bias=True)
@@ -126,28 +106,43 @@ class MultiHeadedAttention(nn.Module):
 
         self.dropout = nn.Dropout(p=dropout)
 
+    def reset_alpha_gamma_parameters(self):
+        "same initialization as nn.Linear, applied to the alpha and gamma layers separately"
+        fan_in = self.alpha_gamma_weight.size(-1)
+        for weight in self.alpha_gamma_weight:
+            nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+        nn.init.uniform_(self.alpha_gamma_bias, -1 / math.sqrt(fan_in), 1 / math.sqrt(fan_in))
+
     def forward(self, query, key, value, mask=None):
         if mask is not None:
-            mask = mask.unsqueeze(1)
+            mask = (mask != 0.).unsqueeze(1) # boolean mask computed once, shared by the attention and the alpha/gamma outputs
 
         batch_size, T = query.size()[:2]
         # q, k ,v each passes through nn.Linear(d_model, d_model, bias=True) before scaled dot-product attention
         # l(x).view(batch_size, -1, self.h, self.d_k).transpose(1, 2) turns rank 3 batch_size * seq_len * d_model into rannk 4 batch_size * self.h * -1 * self.d_k
         query, key, value = [l(x).view(batch_size, -1, self.h, self.d_k).transpose(1, 2)
                              for l, x in zip(self.linear_layers, (query, key, value))]
+        query = query * self.scale
         #Note the value of mu is computed in a multi-head manner : Q @ softmax(K.V)
         v_mu, attn = self.attention.forward(query, key, value, mask=mask, dropout=self.dropout)
-        #Note the attention is repeated for d_k times along the (newly created) last dimension for output (K types?)
-        attn_repeat = torch.repeat_interleave(attn.unsqueeze(-1),self.d_k, -1)
-        # T is query size (number of tokens?)
-        value_repeat = torch.repeat_interleave(value.unsqueeze(2),T,2)
+        #Note the attention is broadcast along the (newly created) last dimension d_k, and the values along the query dimension T
+        #(B x h x L x L x 1) * (B x h x 1 x L x d_k) -> (B x h x L x L x d_k), the repeated inputs are never materialized
+        #under autocast the softmax returns fp32 while value is bf16, cast so the (B x h x L x L x d_k) product is not promoted to fp32
+        attn_value = attn.to(value.dtype).unsqueeze(-1) * value.unsqueeze(2)
 
         mask = mask.permute((0, 2, 3, 1))
         #Note the values of alpha and gamma are computed in an unconventiaonal way, by splitting heads - alpha [:int(self.h/2]  , gamma [int(self.h/2):]
-        v_alpha = self.alpha_layer((attn_repeat[:,:int(self.h/2)]*value_repeat[:,:int(self.h/2)]).contiguous().view(batch_size, T, T, -1))# (B x L x L x K)
-        v_alpha = v_alpha.masked_fill(mask == 0., 0.)
-        v_gamma = self.gamma_layer((attn_repeat[:,int(self.h/2):]*value_repeat[:,int(self.h/2):]).contiguous().view(batch_size, T, T, -1))# (B x L x L x K) 0.1
-        v_gamma = v_gamma.masked_fill(mask == 0., 0.)
+        #(B x h x L x L x d_k) -> (B x 2 x L*L x h/2*d_k), each half is flattened exactly like (B x h/2 x L x L x d_k).view(B, L, L, -1)
+        attn_value = attn_value.view(batch_size, 2, T * T, -1)
+        #one batched GEMM for both layers; the (2 x h/2*d_k x d_k) weight and (2 x 1 x d_k) bias broadcast over B without copies
+        alpha_gamma = (
+            torch.matmul(attn_value, self.alpha_gamma_weight.transpose(1, 2)) + self.alpha_gamma_bias[:, None]
+        ).view(batch_size, 2, T, T, self.d_k)
+        v_alpha = F.softplus(alpha_gamma[:, 0], beta=1.0)# (B x L x L x K)
+        fmask = mask.to(v_alpha.dtype) # cast once; multiplying zeroes the masked pairs in the same pass
+        v_alpha = v_alpha * fmask
+        v_gamma = F.softplus(alpha_gamma[:, 1], beta=10.0)# (B x L x L x K) 0.1
+        v_gamma = v_gamma * fmask
         # v_mu.transpose(1, 2) swaps dimensions 1,2 , turns batch_size * number_heads * seq_len * d_k into batch_size * seq_len * number_heads * d_k , view(batch_size, -1, self.h * self.d_k) further reshape it to batch_size * seq_len * d_model
         v_mu = self.mu_layer(v_mu.transpose(1, 2).contiguous().view(batch_size, -1, self.h * self.d_k)) # view() changes the shape of the tensor without changing data
         #mu_layer contains a linear layer that aggragated over heads and a sigmoid() to output probability
@@ -162,6 +157,8 @@ class InstancewiseSelfAttentiveHawkesProcesses(nn.Module):
         hidden_size: int = 60, #32,
         dropout: float = 0.0,
         num_head: int = 6, # For K types of events, we use multi-head attention with K different heads.
+        torch_compile: bool = False,
+        jit_script: bool = False,
         **kwargs,
     ):
         super().__init__()
@@ -169,17 +166,35 @@ class InstancewiseSelfAttentiveHawkesProcesses(nn.Module):
 
         self.embed = nn.Linear(n_types, embedding_dim, bias=False)
         self.dropout = nn.Dropout(p=dropout)
-        self.m_dt = nn.ReLU()
-        self.softplus_state_decay = nn.Softplus(beta=1.0)
 
         self.multiheadattention = MultiHeadedAttention(h=num_head, d_model=hidden_size) #self.d_model
 
+        self._state_decay_fn = _state_decay
+        self._state_excitation_fn = _state_excitation
+        if torch_compile and hasattr(torch, "compile"):
+            # sequence length varies across batches, hence dynamic shapes
+            self.multiheadattention = torch.compile(self.multiheadattention, dynamic=True, mode="reduce-overhead")
+            self.state_decay = torch.compile(self.state_decay, dynamic=True)
+            self._state_excitation_fn = torch.compile(_state_excitation, dynamic=True)
+        elif jit_script:
+            # the JIT fuser merges the exp/mul chain into a single kernel on CUDA; on CPU it only adds profiling overhead
+            # the checkpointed Monte-Carlo excitation stays eager: the profiling executor changes the graph between the forward
+            # and the recomputation, which non-reentrant checkpointing rejects
+            self._state_decay_fn = torch.jit.script(_state_decay)
+
     # v_mu: vectorized background intensity, v_alpha: vectorized kernel/trigger function, v_gamma: vectorized decay rate function
     def state_decay(self, v_mu, v_alpha, v_gamma, dt_arr): # (B, L-1, K), (B, L-1, L-1, K) , (B, L-1, L-1, K), (B, L-1, L-1, 1)
-        # * element-wise product
-        cell_t = torch.tanh(v_mu + torch.sum(v_alpha * v_gamma * torch.exp(-v_gamma * dt_arr),-3)) # summation along dim:-3 (time)        ??? #+ 1e-3  ???
+        # always in fp32 (inputs may be bf16 under autocast) to keep exp/tanh stable
+        v_mu, v_alpha, v_gamma = v_mu.float(), v_alpha.float(), v_gamma.float()
+        cell_t = self._state_decay_fn(v_mu, v_alpha, v_gamma, dt_arr)
         return cell_t # (B, L-1, K)
 
+    def _mc_excitation(self, v_alpha, v_gamma, dt_meta, dt_offset, n_samples): # (B, L-1, J, K), (B, L-1, J, K), (B, L-1, J), (B, L-1, J)
+        # pre-tanh excitation from a tile of J history events at n_samples uniform points of each inter-event interval
+        taus = torch.rand(*dt_meta.shape, 1, n_samples, device=dt_meta.device) # (B, L-1, J, 1, chunk)
+        taus = dt_meta[:, :, :, None, None] * taus + dt_offset[:, :, :, None, None]
+        return self._state_excitation_fn(v_alpha.float()[:, :, :, :, None], v_gamma.float()[:, :, :, :, None], taus) # (B, L-1, K, chunk)
+
     def forward(
         self, event_seqs, src_mask, onehot=False, target_type=-1
     ):
@@ -197,28 +212,30 @@ class InstancewiseSelfAttentiveHawkesProcesses(nn.Module):
         if onehot:
             type_feat = self.embed(event_seqs[:, :-1, 1:]) # excluding the last element of the second dimension and excluding the first element from the third dimension for the entire tensor
         else:
-            type_feat = self.embed(
-                # torch.nn.functional as F
-                F.one_hot(event_seqs[:, :-1, 1].long(), self.n_types).float()
-            )
+            # one_hot(types) @ embed.weight.T is a row lookup of embed.weight.T, so gather instead of materializing the one-hot tensor
+            type_feat = F.embedding(event_seqs[:, :-1, 1].long(), self.embed.weight.t())
 
         feat = torch.cat([temp_feat, type_feat], dim=-1) #B (batch_size) = 64, L (max_length), embedding_dim + 1  #[64, 336, 20]
         #Should be noted that embedding_dim + 1 = number_of_heads * d_k, in which d_k is number of types. The concept of heads is not implemented explicitly.
-        v_mu, v_alpha, v_gamma = self.multiheadattention.forward(feat,feat,feat, mask=src_mask) #
+        v_mu, v_alpha, v_gamma = self.multiheadattention(feat,feat,feat, mask=src_mask) #
 
         return v_mu, v_alpha, v_gamma
 
+    @staticmethod
+    def _pairwise_dt(event_seqs):
+        t = event_seqs[:, :, 0]
+        return (t[:, 1:, None] - t[:, None, :-1]).abs().tril_() #(B, L-1, L-1), |t_(i+1) - t_j| for j <= i
+
     #Note this function calculate 'negative' log-likelihood , which is (-1) * likelihood function. So the objective is to minimize.
     def _eval_nll(
-        self, event_seqs, src_mask, mask, v_mu, v_alpha, v_gamma, device=None, n_mc_samples = 20
+        self, event_seqs, src_mask, mask, v_mu, v_alpha, v_gamma, n_mc_samples = 20, mc_chunk_size = 4, mc_hist_chunk_size = 64
     ):  
         n_batch = self.ts.size(0)
         n_times = self.ts.size(1) - 2
 
-        dt_arr = torch.tril(torch.cdist(event_seqs[:, :, 0:1], event_seqs[:, :, 0:1], p=2))[:,1:,:-1] #(B, L-1, L-1)
+        dt_arr = self._pairwise_dt(event_seqs) #(B, L-1, L-1)
         dt_seq = torch.diagonal(dt_arr, offset=0, dim1=1, dim2=2) #(B, L-1)
-        torch.set_printoptions(threshold=10000,edgeitems=100)
-        dt_meta = torch.tril(torch.repeat_interleave(torch.unsqueeze(dt_seq,-1),n_times,-1)).masked_fill(src_mask == 0., 0.) #(B, L-1, L-1)
+        dt_meta = dt_seq.unsqueeze(-1) * src_mask #(B, L-1, L-1), broadcast row-wise; src_mask is boolean and already lower triangular
         dt_offset = (dt_arr - dt_meta).masked_fill(src_mask == 0., 0.)
         #Each event in an event sequence is represented as [time, type]. The offset for type is 1.
         type_mask = F.one_hot(event_seqs[:, 1:, 1].long(), self.n_types).float() #The event types are one-hot encoded
@@ -230,18 +247,24 @@ class InstancewiseSelfAttentiveHawkesProcesses(nn.Module):
         #FIXME check if the transpose is correct , why q,k,v embedding dimension has to be the same as number_event_types?
         log_sum = (log_intensities * type_mask).sum(-1).masked_select(mask).sum() #B x L-1 -> B
         #The likelihood that no event occurs during the internval ( introduce random time point during interval and
-        taus = torch.rand(n_batch, n_times, n_times, 1, n_mc_samples).to(device)# self.process_dim replaced 1 (B,L-1,L-1,1,20)
-        taus = dt_meta[:, :, :, None, None] * taus  # inter-event times samples) (B,L-1,L-1,1,20).
-        taus =  taus + dt_offset[:,:,:,None,None] #(B,L-1,L-1,1,20).
-
-        cell_tau = self.state_decay(
-            v_mu[:,:,:,None],
-            v_alpha[:,:,:,:,None],
-            v_gamma[:,:,:,:,None],
-            taus) #(B,L-1, k, 20)
-
-        total_intens_samples = cell_tau.sum(dim=2) #sum over k (B,L-1, 20)
-        partial_integrals = dt_seq * total_intens_samples.mean(dim=2)
+        #The samples are drawn mc_chunk_size at a time and the history (dim -3) is summed mc_hist_chunk_size events at a time before the tanh,
+        #so only a (B,L-1,mc_hist_chunk_size,K,mc_chunk_size) slice is alive at once. Each tile is checkpointed: backward recomputes it
+        #(with the same random samples) instead of keeping it, and only the (B,L-1,K,chunk) excitations are saved.
+        total_intens_samples = 0.
+        for n_done in range(0, n_mc_samples, mc_chunk_size):
+            n_samples = min(mc_chunk_size, n_mc_samples - n_done)
+            excitation = 0.
+            for j in range(0, n_times, mc_hist_chunk_size):
+                tile = (slice(None), slice(None), slice(j, j + mc_hist_chunk_size))
+                tile_args = (v_alpha[tile], v_gamma[tile], dt_meta[tile], dt_offset[tile], n_samples)
+                if torch.is_grad_enabled():
+                    excitation = excitation + checkpoint(self._mc_excitation, *tile_args, use_reentrant=False)
+                else:
+                    excitation = excitation + self._mc_excitation(*tile_args)
+            cell_tau = torch.tanh(v_mu.float()[:, :, :, None] + excitation) #(B,L-1, k, chunk)
+
+            total_intens_samples = total_intens_samples + cell_tau.sum(dim=(2, 3)) #sum over k and samples (B,L-1)
+        partial_integrals = dt_seq * total_intens_samples / n_mc_samples
         partial_integrals = partial_integrals.masked_select(mask) #average samples (B,L-1)
 
         integral_ = partial_integrals.sum() #B
@@ -268,44 +291,54 @@ class InstancewiseSelfAttentiveHawkesProcesses(nn.Module):
         self.train()
 
         train_metrics = defaultdict(AverageMeter)
+        # bf16 autocast for the forward pass and the nll, only on CUDA; no GradScaler is needed for bf16
+        use_amp = bool(kwargs.get("amp")) and device is not None and torch.device(device).type == "cuda"
 
-        for batch in train_dataloader:
+        for batch, seq_length in train_dataloader:
             if device:
-                batch = batch.to(device)
-            seq_length = (batch.abs().sum(-1) > 0).sum(-1)
+                batch = batch.to(device, non_blocking=True)
+                seq_length = seq_length.to(device, non_blocking=True)
             mask = generate_sequence_mask(seq_length)[:,1:] # zero-padding to the max sequence legnth #pad mask
-            masked_seq_types = MaskBatch(batch[:,1:,0], pad=0., device=device) #causal masked sequences
+            masked_seq_types = MaskBatch(batch[:,1:,0], pad=0.) #causal masked sequences
 
-            reg_masked_seq_types = MaskBatch(batch[:,1:,0], pad=0., device=device)
-            reg_src_mask = reg_masked_seq_types.src_mask.unsqueeze(-1)
+            reg_src_mask = masked_seq_types.src_mask.unsqueeze(-1)
             reg_type_mask = F.one_hot(batch[:, :-1, 1].long(), self.n_types).bool().unsqueeze(1)
-            torch.set_printoptions(threshold=10000,edgeitems=100)
-            type_reg_mask = torch.repeat_interleave((reg_src_mask * reg_type_mask).unsqueeze(-2),self.n_types,-2)
+            type_reg_mask = (reg_src_mask & reg_type_mask).reshape(-1, self.n_types) # (B*(L-1)*(L-1), K): pairs (i, j) whose history event j is of type k
 
-            v_mu, v_alpha, v_gamma = self.forward(
-                batch, masked_seq_types.src_mask  # onehot=False
-            )
-
-            nll, integral, log_sum = self._eval_nll(batch, masked_seq_types.src_mask,
-                mask, v_mu, v_alpha, v_gamma, device=device
-            )
-
-            type_reg_score = v_alpha
-            history_grouptype_reg_list = []
-            history_grouptype_mean_list = []
+            with torch.autocast("cuda", dtype=torch.bfloat16, enabled=use_amp):
+                v_mu, v_alpha, v_gamma = self.forward(
+                    batch, masked_seq_types.src_mask  # onehot=False
+                )
 
-            for i in range(type_reg_mask.size(-1)):
-                masked_score_array = type_reg_score.masked_select(type_reg_mask[...,i])
-                masked_score_array = masked_score_array.reshape(self.n_types,-1)
+                nll, integral, log_sum = self._eval_nll(batch, masked_seq_types.src_mask,
+                    mask, v_mu, v_alpha, v_gamma
+                )
 
-                if masked_score_array.nelement() > self.n_types:
-                    history_group_mean = torch.mean(masked_score_array,-1)
-                    history_grouptype_reg = torch.var(masked_score_array,-1)
-                    history_grouptype_reg_list.append(history_grouptype_reg)
-                    history_grouptype_mean_list.append(history_group_mean)
+            type_reg_score = v_alpha.float().reshape(-1, self.n_types) # (B*(L-1)*(L-1), K), reductions below stay in fp32
+            # For history type k, the scores of its n_pairs[k] pairs (K each, in row-major order) are cut into n_types rows of
+            # n_pairs[k] values, i.e. score_array.masked_select(...).reshape(n_types, -1); mean and (unbiased) variance are taken per row.
+            # The rows of all history types are built at once: value m of the p-th pair of type k goes to row (p * K + m) // n_pairs[k].
+            n_pairs = type_reg_mask.sum(0) # (K,)
+            pair_idx, pair_type = type_reg_mask.nonzero(as_tuple=True) # row-major, same order as masked_select
+            pair_rank = (type_reg_mask.cumsum(0) - 1)[pair_idx, pair_type] # p
+            pair_pos = pair_rank.unsqueeze(-1) * self.n_types + torch.arange(self.n_types, device=pair_rank.device) # (E, K)
+            group = pair_type.unsqueeze(-1) * self.n_types + pair_pos // n_pairs[pair_type].unsqueeze(-1) # (E, K): k * K + row
+            group_scores = type_reg_score[pair_idx] # (E, K)
+
+            group_count = n_pairs.unsqueeze(-1) # (K, 1), every row of type k holds n_pairs[k] values
+            history_group_mean = (
+                type_reg_score.new_zeros(self.n_types * self.n_types).scatter_add(0, group.view(-1), group_scores.view(-1))
+                .view(self.n_types, self.n_types) / group_count.clamp(min=1)
+            )
+            group_dev = group_scores - history_group_mean.view(-1)[group] # two-pass variance, no E[x^2] - E[x]^2 cancellation
+            history_grouptype_reg = (
+                type_reg_score.new_zeros(self.n_types * self.n_types).scatter_add(0, group.view(-1), group_dev.pow(2).view(-1))
+                .view(self.n_types, self.n_types) / (group_count - 1).clamp(min=1)
+            )
+            history_group_valid = group_count > 1 # as before, history types with a single pair are skipped
 
-            grouptype_reg = torch.stack(history_grouptype_reg_list).sum()
-            groupsparse_reg = torch.stack(history_grouptype_mean_list).pow(1).sum()
+            grouptype_reg = (history_grouptype_reg * history_group_valid).sum()
+            groupsparse_reg = (history_group_mean * history_group_valid).sum()
 
             if kwargs["type_reg"] > 0:
                 type_reg = (
@@ -348,20 +381,19 @@ class InstancewiseSelfAttentiveHawkesProcesses(nn.Module):
 
         self.eval()
         with torch.no_grad():
-            for batch in dataloader:
+            for batch, seq_length in dataloader:
                 if device:
-                    batch = batch.to(device)
-
-                seq_length = (batch.abs().sum(-1) > 0).sum(-1)
+                    batch = batch.to(device, non_blocking=True)
+                    seq_length = seq_length.to(device, non_blocking=True)
                 mask = generate_sequence_mask(seq_length)[:,1:] #pad mask
-                masked_seq_types = MaskBatch(batch[:,1:,0], pad=0., device=device)
+                masked_seq_types = MaskBatch(batch[:,1:,0], pad=0.)
 
                 v_mu, v_alpha, v_gamma = self.forward(
                     batch, masked_seq_types.src_mask
                 )
 
                 nll, integral, log_sum = self._eval_nll(batch, masked_seq_types.src_mask, 
-                    mask, v_mu, v_alpha, v_gamma, device=device
+                    mask, v_mu, v_alpha, v_gamma
                 )
 
                 metrics["nll"].update(nll, batch.size(0))
@@ -375,22 +407,19 @@ class InstancewiseSelfAttentiveHawkesProcesses(nn.Module):
         device=None,
         **kwargs,
     ):
-        A = torch.zeros(self.n_types, self.n_types)
-        type_counts = torch.zeros(self.n_types, self.n_types)
+        A = torch.zeros(self.n_types, self.n_types, device=device)
+        type_counts = torch.zeros(self.n_types, self.n_types, device=device)
         self.eval()
         with torch.no_grad():
-            for batch in tqdm(dataloader):
+            for batch, _ in tqdm(dataloader):
                 if device:
-                    batch = batch.to(device)
+                    batch = batch.to(device, non_blocking=True)
                 batch_size, T = batch.size()[:2]
-                seq_length = (batch.abs().sum(-1) > 0).sum(-1)
 
-                type_mask_j = F.one_hot(batch[:, :-1, 1].long(), self.n_types).float().detach().cpu() #b, l_j, k
-                type_mask_i = F.one_hot(batch[:, 1:, 1].long(), self.n_types).float().detach().cpu() #b, l_i, k
-                type_mask_i_repeat = torch.repeat_interleave(type_mask_i.unsqueeze(1),T-1,1) #b, l_j, l_i, k
-                type_mask_i_repeat = type_mask_i_repeat.permute((0, 1, 3, 2)) #b, l_j, k, l_i
+                type_mask_j = F.one_hot(batch[:, :-1, 1].long(), self.n_types).float() #b, l_j, k
+                type_mask_i = F.one_hot(batch[:, 1:, 1].long(), self.n_types).float() #b, l_i, k
 
-                masked_seq_types = MaskBatch(batch[:,1:,0], pad=0., device=device)
+                masked_seq_types = MaskBatch(batch[:,1:,0], pad=0.)
                 src_mask = masked_seq_types.src_mask
                 src_mask = src_mask.unsqueeze(-1)
 
@@ -398,12 +427,11 @@ class InstancewiseSelfAttentiveHawkesProcesses(nn.Module):
                     batch, masked_seq_types.src_mask
                 )
                 v_score = v_alpha
-                v_score = v_score.masked_fill(src_mask == 0., 0.).detach().cpu() #b,l_i,l_j,k
+                v_score = v_score.masked_fill(src_mask == 0., 0.) #b,l_i,l_j,k
                 v_score = v_score.permute((0, 2, 1, 3)) #b,l_j,l_i,k
-                v_score = torch.matmul(v_score, type_mask_i_repeat) #b,l_j,l_i,l_i
-                v_score_instance = v_score.diagonal(offset=0, dim1=2, dim2=3) #b,l_j,l_i
+                v_score_instance = (v_score * type_mask_i.unsqueeze(1)).sum(-1) #b,l_j,l_i: score of event j on the type of event i
 
-                count_type = torch.triu(torch.ones(v_score_instance.shape)) #b,l_j,l_i
+                count_type = subsequent_mask(T-1, batch.device).transpose(1, 2).float() #1,l_j,l_i (upper triangle, shared across the batch)
 
                 v_score_agg_i = torch.matmul(v_score_instance, type_mask_i).permute((0, 2, 1)) #b,k_i,l_j
                 v_score_agg = torch.matmul(v_score_agg_i, type_mask_j) #b,k_i,k_j
@@ -414,34 +442,25 @@ class InstancewiseSelfAttentiveHawkesProcesses(nn.Module):
                 A += torch.sum(v_score_agg, 0) #k,k
                 type_counts += torch.sum(count_agg, 0)  #k,k
 
-        return A/(type_counts+1)
+        return (A/(type_counts+1)).cpu()
 
     def predict_next_event_type(self, dataloader, device=None):
         self.eval()
         event_seqs_pred_type = []
         event_seqs_truth_type = []
         with torch.no_grad():
-            for batch in dataloader:
+            for batch, seq_length in dataloader:
                 if device:
-                    batch = batch.to(device)
-
-                seq_length = (batch.abs().sum(-1) > 0).sum(-1)
+                    batch = batch.to(device, non_blocking=True)
+                    seq_length = seq_length.to(device, non_blocking=True)
                 mask = generate_sequence_mask(seq_length)[:,1:] #pad mask
-                masked_seq_types = MaskBatch(batch[:,1:,0], pad=0., device=device)
+                masked_seq_types = MaskBatch(batch[:,1:,0], pad=0.)
 
                 v_mu, v_alpha, v_gamma = self.forward(
                     batch, masked_seq_types.src_mask
                 )
 
-                src_mask = masked_seq_types.src_mask
-
-                n_batch = self.ts.size(0)
-                n_times = self.ts.size(1) - 2
-
-                dt_arr = torch.tril(torch.cdist(batch[:, :, 0:1], batch[:, :, 0:1], p=2))[:,1:,:-1] #(B, L-1, L-1)
-                dt_seq = torch.diagonal(dt_arr, offset=0, dim1=1, dim2=2) #(B, L-1)
-                dt_meta = torch.tril(torch.repeat_interleave(torch.unsqueeze(dt_seq,-1),n_times,-1)).masked_fill(src_mask == 0., 0.) #(B, L-1, L-1)
-                dt_offset = (dt_arr - dt_meta).masked_fill(src_mask == 0., 0.)
+                dt_arr = self._pairwise_dt(batch) #(B, L-1, L-1)
 
                 intensities = self.state_decay(v_mu, v_alpha, v_gamma, dt_arr[:,:,:,None]) #(B, L-1, K)
 
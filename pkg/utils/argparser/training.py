@@ -72,6 +72,25 @@ def add_subparser_arguments(model, subparsers):
         sub_parser.add_argument(
             "--num_workers", type=int, default=0, help="default: 0"
         )
+        sub_parser.add_argument(
+            "--torch_compile",
+            action="store_true",
+            help="Whether to compile the attention and state decay with "
+            "torch.compile (PyTorch >= 2.0). default: False",
+        )
+        sub_parser.add_argument(
+            "--jit_script",
+            action="store_true",
+            help="Whether to script the state decay with torch.jit.script so "
+            "that it is fused on CUDA; ignored with --torch_compile. "
+            "default: False",
+        )
+        sub_parser.add_argument(
+            "--amp",
+            action="store_true",
+            help="Whether to train with bfloat16 autocast (CUDA only). "
+            "default: False",
+        )
         sub_parser.add_argument(
             "--bucket_seqs",
             action="store_true",
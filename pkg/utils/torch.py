@@ -93,7 +93,13 @@ def split_dataloader(dataloader, ratio: float):
     lengths = [int(n * ratio), n - int(n * ratio)]
     datasets = torch.utils.data.random_split(dataset, lengths)
 
-    copied_fields = ["batch_size", "num_workers", "collate_fn", "drop_last"]
+    copied_fields = [
+        "batch_size",
+        "num_workers",
+        "collate_fn",
+        "drop_last",
+        "pin_memory",
+    ]
     dataloaders = []
     for d in datasets:
         dataloaders.append(
@@ -210,6 +216,7 @@ def convert_to_bucketed_dataloader(
         batch_sampler=batch_sampler,
         collate_fn=dataloader.collate_fn,
         num_workers=dataloader.num_workers,
+        pin_memory=dataloader.pin_memory,
     )
 
 
@@ -235,13 +235,15 @@ if __name__ == "__main__":
         model = get_model(args, n_types)
 
         if args.model in ["ISAHP"]:
+            device = get_device(args.cuda)
+            print('device:',device, flush=True)
             dataloader_args = {
                 "batch_size": args.batch_size,
                 "collate_fn": EventSeqDataset.collate_fn,
                 "num_workers": args.num_workers,
+                # page-locked batches let batch.to(device, non_blocking=True) overlap with compute
+                "pin_memory": device.type == "cuda",
             }
-            device = get_device(args.cuda)
-            print('device:',device, flush=True)
 
             model = model.to(device)
             model = train_nn_models(model, train_event_seqs, args)